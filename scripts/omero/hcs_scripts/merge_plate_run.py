@@ -23,10 +23,12 @@ Created by Tom Boissonnet
 
 """
 
-from omero.gateway import BlitzGateway
+from collections import defaultdict
+
+from omero.gateway import BlitzGateway, PlateAcquisitionWrapper
 import omero
 from omero.model import WellI
-from omero.rtypes import rlong, rstring, robject
+from omero.rtypes import rlong, rstring, robject, unwrap
 import omero.scripts as scripts
 
 
@@ -36,6 +38,49 @@ P_TARGET_PLATE_ID = "Target Plate ID"
 P_SORTING = "Order runs by"
 
 
+def _load_plates(conn, plate_ids):
+    """
+    Load the plates with their wells and well samples in a single query.
+    Returns a dictionary of omero.model.PlateI keyed by plate ID.
+    """
+    params = omero.sys.ParametersI().addIds(list(plate_ids))
+    query = ("select distinct p from Plate p "
+             "left outer join fetch p.wells w "
+             "left outer join fetch w.wellSamples ws "
+             "where p.id in (:ids)")
+    plates = conn.getQueryService().findAllByQuery(query, params, conn.SERVICE_OPTS)
+    return {plate.id.val: plate for plate in plates}
+
+
+def _wells_by_pos(plate):
+    """
+    Return the wells of a loaded omero.model.PlateI keyed by (row, column).
+    """
+    return {(well.row.val, well.column.val): well for well in plate.copyWells()}
+
+
+def _index_label(index, convention):
+    """
+    Return the label of a 0-based row or column index following a plate
+    naming convention, e.g. 0 -> 'A' for 'letter' and 0 -> '1' for 'number'.
+    """
+    if convention != "letter":
+        return str(index + 1)
+    index, letters = index + 1, ""
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def _well_label(well_pos, row_naming, column_naming):
+    """
+    Return a (row, column) well position as a string, e.g. (0, 0) -> 'A1'.
+    """
+    return (_index_label(well_pos[0], row_naming) +
+            _index_label(well_pos[1], column_naming))
+
+
 def combine_plates(conn, target_plate_id, source_ids, source_type,
                    sort_way, same_screen=True):
     """
@@ -55,101 +100,168 @@ def combine_plates(conn, target_plate_id, source_ids, source_type,
     if type(source_ids) is int:
         source_ids = [source_ids]
 
-    target_plate = conn.getObject("Plate", target_plate_id)
-    assert target_plate is not None, f"Target Plate:{target_plate} not found."
-
-    plate_run_l = []
+    run_l = []
     if source_type == "Plate":
         # Make sure target is not in source_ids
         source_ids = set(source_ids).difference({target_plate_id})
+        plate_ids = source_ids
+    else:
+        run_l = list(conn.getObjects("PlateAcquisition", source_ids))
+        plate_ids = {run_o._obj.plate.id.val for run_o in run_l}
+
+    # Fetch the target and all source plates at once
+    plates_by_id = {p.getId(): p for p in
+                    conn.getObjects("Plate", list(plate_ids) + [target_plate_id])}
+    target_plate = plates_by_id.get(target_plate_id)
+    if target_plate is None:
+        raise AssertionError(f"Target Plate:{target_plate_id} not found.")
+    # Unloaded reference, avoids sending the whole plate with every save
+    target_plate_ref = omero.model.PlateI(target_plate_id, False)
 
-        for plate_id in source_ids:
+    plate_run_l = []
+    if source_type == "Plate":
+        missing_ids = sorted(source_ids.difference(plates_by_id))
+        if missing_ids:
+            ids = ', '.join(map(str, missing_ids))
+            raise AssertionError(f"Source Plate:{ids} not found.")
+
+        # Fetch the runs of all source plates in one query
+        runs_by_plate = defaultdict(list)
+        if source_ids:
+            params = omero.sys.ParametersI().addIds(list(source_ids))
+            for plate_acq in conn.getQueryService().findAllByQuery(
+                    "select pa from PlateAcquisition pa where pa.plate.id in (:ids) "
+                    "order by pa.id", params, conn.SERVICE_OPTS):
+                runs_by_plate[plate_acq.plate.id.val].append(plate_acq)
+
+        new_runs = []
+        runless_ids = source_ids.difference(runs_by_plate)
+        runless_d = _load_plates(conn, runless_ids) if runless_ids else {}
+        for plate_id in runless_ids:
             # Verification that all plates have runs; if not create one.
-            plate_o = conn.getObject("Plate", plate_id)
-            if len(list(plate_o.listPlateAcquisitions())) == 0:
-                # No Run on this Plate
-                plate_acq_o = omero.model.PlateAcquisitionI()
-                plate_acq_o.name = omero.rtypes.RStringI(plate_o.getName())
-                plate_acq_o.plate = omero.model.PlateI(plate_o.getId(), False)
-
-                all_ws = []
-                for well in plate_o.listChildren():
-                    for ws in well.listChildren():
-                        all_ws.append(ws._obj)
-                plate_acq_o.addAllWellSampleSet(all_ws)
-                update_service.saveObject(plate_acq_o)
-
-        # Reload all objects and create (plate_obj, run_obj) tuples
-        for plate_o in conn.getObjects("Plate", source_ids):
-            plate_run_l.extend([(plate_o, run_o) for run_o in plate_o.listPlateAcquisitions()])
+            plate_o = plates_by_id[plate_id]
+            plate_acq_o = omero.model.PlateAcquisitionI()
+            plate_acq_o.name = omero.rtypes.RStringI(plate_o.getName())
+            plate_acq_o.plate = omero.model.PlateI(plate_o.getId(), False)
+
+            all_ws = []
+            for well in runless_d[plate_id].copyWells():
+                all_ws.extend(well.copyWellSamples())
+            plate_acq_o.addAllWellSampleSet(all_ws)
+            new_runs.append(plate_acq_o)
+
+        if new_runs:
+            for plate_acq in update_service.saveAndReturnArray(new_runs):
+                # The well samples are reloaded with the plates below
+                plate_acq.unloadWellSample()
+                runs_by_plate[plate_acq.plate.id.val].append(plate_acq)
+
+        # Create (plate_obj, run_obj) tuples, including the new runs
+        for plate_id in source_ids:
+            plate_o = plates_by_id[plate_id]
+            plate_run_l.extend([(plate_o, PlateAcquisitionWrapper(conn, plate_acq))
+                                for plate_acq in runs_by_plate[plate_id]])
     else:
-        plate_run_l = [(run_o.getParent(), run_o) for run_o in conn.getObjects("PlateAcquisition", source_ids)]
+        plate_run_l = [(plates_by_id[run_o._obj.plate.id.val], run_o) for run_o in run_l]
+
+    # Load wells and well samples of all plates at once, once the new runs
+    # exist so that every well sample is up to date
+    graph_d = _load_plates(conn, plates_by_id.keys())
 
     if sort_way == "Plate & run name":
         plate_run_l = sorted(plate_run_l, key=lambda x: (x[0].getName(), x[1].getName()))
     elif sort_way == "Acquisition name":
         plate_run_l = sorted(plate_run_l, key=lambda x: x[1].getName())
     elif sort_way == "Acquisition start time":
-        all_time = [r.getStartTime() for p, r in plate_run_l]
-        assert None not in all_time, "Some runs don't have a start acquisition time."
-        plate_run_l = sorted(plate_run_l, key=lambda x: x.getStartTime())
+        # Get each start time once, the index keeps the sort stable
+        times = [(r.getStartTime(), i, p, r) for i, (p, r) in enumerate(plate_run_l)]
+        if any(t[0] is None for t in times):
+            raise AssertionError("Some runs don't have a start acquisition time.")
+        times.sort(key=lambda x: x[:2])
+        plate_run_l = [(p, r) for _, _, p, r in times]
 
     print("\n".join([pr[1].getName() for pr in plate_run_l]))
 
     if same_screen:
-        screen_l = []
-        plate_l = []
-        for plate, _ in plate_run_l + [(target_plate, None)]:
-            screen = plate.getParent()
-            if screen is None:
-                plate_l.append(plate.getId())
-                continue
-            screen_l.append(screen.getId())
-        screen_l = list(set(screen_l))
-
-        ids = ', '.join(map(str, plate_l))
-        assert len(plate_l) == 0, f"Screen safety error: plate {ids} not part of a screen"
-        assert len(screen_l) == 1, f"Screen safety error: Plates belong to different Screens, {screen_l}"
-
-    well_d = {}
-    for well in target_plate.listChildren():
-        well_d[well.getWellPos()] = well._obj
+        # Get the screens of all plates in one query
+        all_ids = {plate.getId() for plate, _ in plate_run_l} | {target_plate_id}
+        params = omero.sys.ParametersI().addIds(list(all_ids))
+        rows = conn.getQueryService().projection(
+            "select distinct l.child.id, l.parent.id from ScreenPlateLink l "
+            "where l.child.id in (:ids)", params, conn.SERVICE_OPTS)
+        screen_l = list({row[1].val for row in rows})
+        plate_l = sorted(all_ids.difference(row[0].val for row in rows))
+
+        if plate_l:
+            ids = ', '.join(map(str, plate_l))
+            raise AssertionError(f"Screen safety error: plate {ids} not part of a screen")
+        if len(screen_l) != 1:
+            raise AssertionError(f"Screen safety error: Plates belong to different Screens, {screen_l}")
+
+    well_d = _wells_by_pos(graph_d[target_plate_id])
+
+    # Index the well samples of the source plates by run id and well position
+    source_wells = []
+    ws_by_run = defaultdict(dict)
+    for plate_id in dict.fromkeys(plate.getId() for plate, _ in plate_run_l):
+        for well in graph_d[plate_id].copyWells():
+            well_pos = (well.row.val, well.column.val)
+            for ws in well.copyWellSamples():
+                run_id = ws.plateAcquisition.id.val
+                ws_by_run[run_id].setdefault(well_pos, []).append(ws)
+            source_wells.append((well_pos, well))
 
     # Populating target with missing wells
-    new_well_count = 0
-    for plate, _ in plate_run_l:
-        for well in plate.listChildren():
-            if well.getWellPos() not in well_d.keys():
-                new_well = WellI()
-                new_well.setColumn(well._obj.getColumn())
-                new_well.setRow(well._obj.getRow())
-                new_well.setPlate(target_plate._obj)
-                well_d[well.getWellPos()] = update_service.saveAndReturnObject(new_well)
-                print(f"Create {well.getWellPos()}")
-                new_well_count += 1
+    new_wells = []
+    new_well_keys = []
+    for well_pos, well in source_wells:
+        if well_pos in well_d:
+            continue
+        new_well = WellI()
+        new_well.setColumn(well.getColumn())
+        new_well.setRow(well.getRow())
+        new_well.setPlate(target_plate_ref)
+        # Placeholder so the position is only submitted once
+        well_d[well_pos] = new_well
+        new_wells.append(new_well)
+        new_well_keys.append(well_pos)
+
+    # Save all new wells at once, the server returns them in input order
+    if new_wells:
+        # Same defaults as OMERO when the plate has no naming convention
+        plate_obj = target_plate._obj
+        row_naming = (unwrap(plate_obj.rowNamingConvention) or "letter").lower()
+        column_naming = (unwrap(plate_obj.columnNamingConvention) or "number").lower()
+        print("Create: " + ", ".join(_well_label(pos, row_naming, column_naming)
+                                     for pos in new_well_keys))
+        saved = update_service.saveAndReturnArray(new_wells)
+        for i, key in enumerate(new_well_keys):
+            well_d[key] = saved[i]
+    new_well_count = len(new_wells)
 
     count_well_sample = 0
     for plate, run in plate_run_l:
-        for well in plate.listChildren():
-            well_oi = well_d[well.getWellPos()]
+        for well_pos, wsamples in ws_by_run[run.getId()].items():
+            well_oi = well_d[well_pos]
 
-            for ws in filter(lambda x: x._obj.plateAcquisition._id._val == run.getId(),
-                             well.listChildren()):
-                ws._obj.setWell(well_oi)
-                well_oi.addWellSample(ws._obj)
+            for ws in wsamples:
+                ws.setWell(well_oi)
+                well_oi.addWellSample(ws)
                 count_well_sample += 1
 
-        for _, well_oi in well_d.items():
-            _ = update_service.saveAndReturnObject(well_oi)
-
-        run._obj.setPlate(target_plate._obj)
-        _ = update_service.saveAndReturnObject(run._obj)
-
-        # Need to reload all target objects here
-        target_plate = conn.getObject("Plate", target_plate.getId())
-        well_d = {}
-        for well in target_plate.listChildren():
-            well_d[well.getWellPos()] = well._obj
+        # Save the wells and the moved run in one call
+        run._obj.setPlate(target_plate_ref)
+        well_keys = list(well_d.keys())
+        saved = update_service.saveAndReturnArray(list(well_d.values()) + [run._obj])
+
+        # Saved objects come back in input order. They can be reused for the
+        # next run as long as they have an ID and their well samples loaded.
+        saved_wells = saved[:-1]
+        if all(well.id is not None and well.isWellSamplesLoaded()
+               for well in saved_wells):
+            well_d = dict(zip(well_keys, saved_wells))
+        else:
+            well_d = _wells_by_pos(_load_plates(conn, [target_plate_id])[target_plate_id])
 
     print("\n------------------------------------\n")
     message = (f"{count_well_sample} Images from {len(plate_run_l)} " +